@@ -1,19 +1,23 @@
+from collections import OrderedDict
 from collections.abc import Generator
 from typing import Any
+import hashlib
 import io
-import os
+import logging
 import re
+import threading
 import zipfile
-import shutil
+from xml.sax.saxutils import escape, quoteattr
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 from docx import Document
-from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml import parse_xml
 from docx.oxml.ns import nsdecls
-from docx.shared import Pt
-from lxml import etree
+from docx.shared import Emu, Inches
+from lxml import etree, html
+
+logger = logging.getLogger(__name__)
 
 # ==== 常量定义 ====
 NS_CT = "http://schemas.openxmlformats.org/package/2006/content-types"
@@ -21,6 +25,10 @@ NS_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
 REL_TYPE_NUMBERING = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/numbering"
 REL_TYPE_STYLES = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
 REL_TYPE_THEME = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/theme"
+RID_PATTERN = re.compile(r"rId(\d+)")
+
+# docx必需的核心部件
+REQUIRED_PARTS = ("[Content_Types].xml", "word/document.xml")
 
 PARTS_TO_COPY = [
     "word/styles.xml",
@@ -42,117 +50,244 @@ CONTENT_TYPES = {
     "/word/settings.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.settings+xml",
 }
 
+# div的class到段落样式的映射
+STYLE_BY_CLASS = {
+    "title": "A标题",
+    "text": "A正文",
+    "onetitle": "A一级标题",
+    "twotitle": "A二级标题",
+    "threetitle": "A三级标题",
+}
+
+# 模板中缺少自定义样式时回退使用的内置样式
+FALLBACK_STYLES = {
+    "A标题": "Title",
+    "A正文": "Normal",
+    "A一级标题": "Heading 1",
+    "A二级标题": "Heading 2",
+    "A三级标题": "Heading 3",
+}
+TABLE_STYLE = "Table Grid"
+
+# 块级标签：其前后的文字分属不同段落
+BLOCK_TAGS = frozenset({
+    "div", "table", "p", "section", "article", "blockquote",
+    "ul", "ol", "li", "h1", "h2", "h3", "h4", "h5", "h6",
+})
+
+# 内容中可能出现的HTML标签；其余位置的 "<" 视为普通文字
+KNOWN_TAGS = (
+    "div", "table", "thead", "tbody", "tfoot", "tr", "th", "td", "caption", "colgroup", "col",
+    "p", "br", "hr", "span", "b", "i", "u", "s", "em", "strong", "sub", "sup", "a", "font",
+    "section", "article", "blockquote", "ul", "ol", "li", "pre", "code",
+    "h1", "h2", "h3", "h4", "h5", "h6",
+)
+# 不构成标签的 "<"：后面既不是 "/"、"!"、"?"，也不是形如 <tag attr="v"> 的已知标签
+STRAY_LT_PATTERN = re.compile(
+    r"""<(?![/!?]|(?:%s)(?:\s+[\w:.-]+\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'<>]+))*\s*/?>)"""
+    % "|".join(KNOWN_TAGS),
+    re.IGNORECASE,
+)
+
+# 表格单元格的固定XML片段：表头背景色、居中段落、10号字
+HEADER_SHADING_XML = '<w:shd w:fill="5B9BD5"/>'
+CELL_PARAGRAPH_OPEN = '<w:p><w:pPr><w:jc w:val="center"/></w:pPr>'
+CELL_FONT_SIZE_XML = '<w:sz w:val="20"/>'
+CELL_CLOSE = '</w:t></w:r></w:p></w:tc>'
+# 单元格文字中的换行和制表符，与python-docx设置cell.text时的处理一致
+CELL_LINE_BREAK_XML = '</w:t><w:br/><w:t xml:space="preserve">'
+CELL_TAB_XML = '</w:t><w:tab/><w:t xml:space="preserve">'
+
+# 模板合并结果缓存，按模板内容哈希索引
+MERGE_CACHE_SIZE = 8
+_merge_cache = OrderedDict()
+_merge_cache_lock = threading.Lock()
+
 
 # ==== 工具函数 ====
-def unzip_docx(docx_path, extract_dir):
-    if os.path.exists(extract_dir):
-        shutil.rmtree(extract_dir)
-    os.makedirs(extract_dir)
-    with zipfile.ZipFile(docx_path, 'r') as zf:
-        zf.extractall(extract_dir)
-
-
-def zip_dir(input_dir, output_docx):
-    with zipfile.ZipFile(output_docx, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(input_dir):
-            for f in files:
-                full = os.path.join(root, f)
-                arc = os.path.relpath(full, input_dir)
-                zipf.write(full, arc)
-
-
-def ensure_content_type_override(ct_path, partname, content_type):
-    tree = etree.parse(ct_path)
-    root = tree.getroot()
-    found = root.xpath(f'ct:Override[@PartName="{partname}"]', namespaces={"ct": NS_CT})
-    if not found:
+def serialize_xml(root):
+    return etree.tostring(root, xml_declaration=True, encoding="utf-8", standalone=True)
+
+
+def ensure_content_type_overrides(ct_xml, overrides):
+    root = etree.fromstring(ct_xml)
+    existing = {el.get("PartName") for el in root.findall(f"{{{NS_CT}}}Override")}
+    changed = False
+    for partname, content_type in overrides.items():
+        if partname in existing:
+            continue
         override = etree.Element(f"{{{NS_CT}}}Override")
         override.set("PartName", partname)
         override.set("ContentType", content_type)
         root.append(override)
-        tree.write(ct_path, xml_declaration=True, encoding="utf-8", standalone="yes")
-
-
-def read_relationships(doc_rels_path):
-    if not os.path.exists(doc_rels_path):
-        os.makedirs(os.path.dirname(doc_rels_path), exist_ok=True)
-        root = etree.Element(f"{{{NS_REL}}}Relationships")
-        tree = etree.ElementTree(root)
-        tree.write(doc_rels_path, xml_declaration=True, encoding="utf-8", standalone="yes")
-    tree = etree.parse(doc_rels_path)
-    return tree
-
-
-def ensure_relationship(doc_rels_path, rel_type, target):
-    tree = read_relationships(doc_rels_path)
-    root = tree.getroot()
-    nsmap = {"r": NS_REL}
-    exists = root.xpath(
-        f'r:Relationship[@Type="{rel_type}" and @Target="{target}"]',
-        namespaces=nsmap
-    )
-    if exists:
-        tree.write(doc_rels_path, xml_declaration=True, encoding="utf-8", standalone="yes")
-        return
-
-    existing_ids = set([el.get("Id") for el in root.findall(f"{{{NS_REL}}}Relationship") if el.get("Id")])
-    next_num = 1
-    rid = f"rId{next_num}"
-    while rid in existing_ids:
-        next_num += 1
-        rid = f"rId{next_num}"
-
-    rel = etree.Element(f"{{{NS_REL}}}Relationship")
-    rel.set("Id", rid)
-    rel.set("Type", rel_type)
-    rel.set("Target", target)
-    root.append(rel)
-    tree.write(doc_rels_path, xml_declaration=True, encoding="utf-8", standalone="yes")
-
-
-def safe_copy(src_root, dst_root, rel_path):
-    src = os.path.join(src_root, rel_path)
-    dst = os.path.join(dst_root, rel_path)
-    if os.path.exists(src):
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.copy2(src, dst)
-        return True
-    return False
-
-
-def copy_styles_and_dependencies_from_template(template_path, output_path):
-    # 新建空白docx
-    Document().save(output_path)
-
-    # 解压模板和空白文档
-    t_dir = "_tmp_tpl_unzip"
-    b_dir = "_tmp_blank_unzip"
-    unzip_docx(template_path, t_dir)
-    unzip_docx(output_path, b_dir)
+        changed = True
+    if not changed:
+        return ct_xml
+    return serialize_xml(root)
+
+
+def read_relationships(doc_rels_xml):
+    if doc_rels_xml is None:
+        return etree.Element(f"{{{NS_REL}}}Relationships")
+    return etree.fromstring(doc_rels_xml)
+
+
+def ensure_relationships(doc_rels_xml, relationships):
+    root = read_relationships(doc_rels_xml)
+    existing = set()
+    # 新关系的Id从现有最大的rId编号往后递增
+    max_num = 0
+    for el in root.iterfind(f"{{{NS_REL}}}Relationship"):
+        existing.add((el.get("Type"), el.get("Target")))
+        match = RID_PATTERN.fullmatch(el.get("Id", ""))
+        if match:
+            max_num = max(max_num, int(match.group(1)))
+    changed = False
+    for rel_type, target in relationships:
+        if (rel_type, target) in existing:
+            continue
+
+        max_num += 1
+        rel = etree.Element(f"{{{NS_REL}}}Relationship")
+        rel.set("Id", f"rId{max_num}")
+        rel.set("Type", rel_type)
+        rel.set("Target", target)
+        root.append(rel)
+        existing.add((rel_type, target))
+        changed = True
+    if not changed and doc_rels_xml is not None:
+        return doc_rels_xml
+    return serialize_xml(root)
+
+
+def read_parts(docx_bytes, wanted, required=()):
+    """只读取docx中需要的部件，返回 {部件名: 字节内容}；缺少required中的部件时抛出ValueError"""
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as zf:
+        names = set(zf.namelist())
+        if not names.issuperset(required):
+            raise ValueError("模板文件不是有效的DOCX格式")
+        return {name: zf.read(name) for name in wanted if name in names}
+
+
+def merge_template_styles(template_bytes, blank_bytes):
+    """将模板的样式及相关部件合并到空白docx中，全程在内存中完成，返回合并后的docx字节流"""
+    with zipfile.ZipFile(io.BytesIO(blank_bytes)) as blank:
+        parts = {name: blank.read(name) for name in blank.namelist()}
 
     # 复制样式相关部件
-    for part in PARTS_TO_COPY:
-        safe_copy(t_dir, b_dir, part)
+    parts.update(read_parts(template_bytes, PARTS_TO_COPY, required=REQUIRED_PARTS))
 
     # 修正Content_Types.xml
-    ct_path = os.path.join(b_dir, "[Content_Types].xml")
-    for partname, ctype in CONTENT_TYPES.items():
-        if os.path.exists(os.path.join(b_dir, partname.lstrip("/"))):
-            ensure_content_type_override(ct_path, partname, ctype)
+    ct_name = "[Content_Types].xml"
+    overrides = {
+        partname: ctype for partname, ctype in CONTENT_TYPES.items()
+        if partname.lstrip("/") in parts
+    }
+    parts[ct_name] = ensure_content_type_overrides(parts[ct_name], overrides)
 
     # 确保document.xml.rels关系
-    doc_rels_path = os.path.join(b_dir, "word/_rels/document.xml.rels")
-    ensure_relationship(doc_rels_path, REL_TYPE_STYLES, "styles.xml")
-    ensure_relationship(doc_rels_path, REL_TYPE_THEME, "theme/theme1.xml")
-    if os.path.exists(os.path.join(b_dir, "word/numbering.xml")):
-        ensure_relationship(doc_rels_path, REL_TYPE_NUMBERING, "numbering.xml")
+    rels_name = "word/_rels/document.xml.rels"
+    relationships = [(REL_TYPE_STYLES, "styles.xml"), (REL_TYPE_THEME, "theme/theme1.xml")]
+    if "word/numbering.xml" in parts:
+        relationships.append((REL_TYPE_NUMBERING, "numbering.xml"))
+    parts[rels_name] = ensure_relationships(parts.get(rels_name), relationships)
 
     # 重新打包
-    zip_dir(b_dir, output_path)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as zipf:
+        for name, data in parts.items():
+            # 使用默认时间戳的ZipInfo，输出只取决于部件内容
+            zipf.writestr(zipfile.ZipInfo(name), data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+    return output.getvalue()
+
+
+def make_blank_docx_bytes():
+    blank_bytes = io.BytesIO()
+    Document().save(blank_bytes)
+    return blank_bytes.getvalue()
+
+
+# python-docx默认空白文档，导入时生成一次
+BLANK_DOCX_BYTES = make_blank_docx_bytes()
+
+
+def merged_template_for(template_bytes):
+    """返回合并了模板样式的空白docx字节流，同一模板的合并结果会被缓存复用"""
+    key = hashlib.blake2b(template_bytes, digest_size=16).digest()
+    with _merge_cache_lock:
+        merged = _merge_cache.get(key)
+        if merged is not None:
+            _merge_cache.move_to_end(key)
+            return merged
+
+    merged = merge_template_styles(template_bytes, BLANK_DOCX_BYTES)
+
+    with _merge_cache_lock:
+        _merge_cache[key] = merged
+        while len(_merge_cache) > MERGE_CACHE_SIZE:
+            _merge_cache.popitem(last=False)
+    return merged
+
+
+def escape_stray_lt(content):
+    """将不构成已知标签的 "<" 转义为 "&lt;"，避免HTML解析器把其后的文字当作标签丢弃
+
+    >>> escape_stray_lt('x<y')
+    'x&lt;y'
+    >>> escape_stray_lt('<div class="text">A<B组对比</div>')
+    '<div class="text">A&lt;B组对比</div>'
+    >>> escape_stray_lt('if a<b and c>d then')
+    'if a&lt;b and c>d then'
+    >>> escape_stray_lt('<td>a<b</td><b>粗</b><br/>')
+    '<td>a&lt;b</td><b>粗</b><br/>'
+    """
+    return STRAY_LT_PATTERN.sub("&lt;", content)
+
+
+def is_block_element(el):
+    """元素本身是块级标签，或其中包含块级标签时视为块级元素"""
+    if not isinstance(el.tag, str):
+        return False
+    return el.tag in BLOCK_TAGS or next(el.iterdescendants(*BLOCK_TAGS), None) is not None
 
-    # 清理临时文件
-    shutil.rmtree(t_dir, ignore_errors=True)
-    shutil.rmtree(b_dir, ignore_errors=True)
+
+def cell_text_xml(text):
+    """转义单元格文字，并把换行、制表符转换为w:br、w:tab"""
+    text = escape(text).replace('\r\n', '\n').replace('\r', '\n')
+    return text.replace('\n', CELL_LINE_BREAK_XML).replace('\t', CELL_TAB_XML)
+
+
+def build_table_xml(table_data, col_width, style_id=None):
+    """根据表格数据一次性拼接完整的w:tbl元素，首行作为表头（加粗、背景色），文字居中10号字"""
+    cols = len(table_data[0])
+    tbl_style = f'<w:tblStyle w:val={quoteattr(style_id)}/>' if style_id else ''
+    grid = f'<w:gridCol w:w="{col_width}"/>' * cols
+
+    # 单元格除文字外的部分每张表只拼接一次，逐个单元格只需转义文字
+    tc_width = f'<w:tcW w:type="dxa" w:w="{col_width}"/>'
+    header_cell_open = (
+        f'<w:tc><w:tcPr>{tc_width}{HEADER_SHADING_XML}</w:tcPr>{CELL_PARAGRAPH_OPEN}'
+        f'<w:r><w:rPr><w:b/>{CELL_FONT_SIZE_XML}</w:rPr><w:t xml:space="preserve">'
+    )
+    body_cell_open = (
+        f'<w:tc><w:tcPr>{tc_width}</w:tcPr>{CELL_PARAGRAPH_OPEN}'
+        f'<w:r><w:rPr>{CELL_FONT_SIZE_XML}</w:rPr><w:t xml:space="preserve">'
+    )
+
+    rows = []
+    for i, row in enumerate(table_data):
+        cell_open = header_cell_open if i == 0 else body_cell_open
+        cells = ''.join(cell_open + cell_text_xml(text) + CELL_CLOSE for text in (row + [''] * cols)[:cols])
+        rows.append(f'<w:tr>{cells}</w:tr>')
+    return (
+        f'<w:tbl {nsdecls("w")}>'
+        f'<w:tblPr>{tbl_style}<w:tblW w:type="auto" w:w="0"/>'
+        f'<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0"'
+        f' w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+        f'<w:tblGrid>{grid}</w:tblGrid>'
+        f'{"".join(rows)}'
+        f'</w:tbl>'
+    )
 
 
 # ==== 主工具类 ====
@@ -303,140 +438,107 @@ class DocxWithTemplateStyleTool(Tool):
         #         if os.path.exists(tmp_output):
         #             os.remove(tmp_output)
 
-        def generate_docx_with_template(template_bytes, markdown_content):
-            """从模板字节流和markdown内容生成目标docx字节流"""
-            # 临时文件路径
-            tmp_template = "tmp_template.docx"
-            tmp_output = "tmp_output.docx"
-
+        def generate_docx_with_template(merged_bytes, markdown_content):
+            """从合并了模板样式的docx字节流和markdown内容生成目标docx字节流"""
             try:
-                # 保存模板字节流为临时文件
-                with open(tmp_template, "wb") as f:
-                    f.write(template_bytes)
-
-                # 复制模板样式到空白docx
-                copy_styles_and_dependencies_from_template(tmp_template, tmp_output)
-
                 # 加载带样式的docx并解析markdown写入内容
-                target_doc = Document(tmp_output)
-                lines = markdown_content.split('\n')
-                i = 0
-                while i < len(lines):
-                    print("this is i , i = " + str(i))
-                    line = lines[i].strip()
-                    # 标题处理
-                    if line.startswith('<div class="title"'):
-                        match = re.search(r'>(.*?)</div>', line)
-                        if match:
-                            p = target_doc.add_paragraph()
-                            p.style = "A标题"
-                            p.add_run(match.group(1))
-                    # 普通文本处理
-                    elif line.startswith('<div class="text"'):
-                        match = re.search(r'>(.*?)</div>', line)
-                        if match:
-                            p = target_doc.add_paragraph()
-                            p.style = "A正文"
-                            p.add_run(match.group(1))
-                    # 一级标题处理
-                    elif line.startswith('<div class="onetitle"'):
-                        match = re.search(r'>(.*?)</div>', line)
-                        if match:
-                            p = target_doc.add_paragraph()
-                            p.style = "A一级标题"
-                            p.add_run(match.group(1))
-                    # 二级标题处理
-                    elif line.startswith('<div class="twotitle"'):
-                        match = re.search(r'>(.*?)</div>', line)
-                        if match:
-                            p = target_doc.add_paragraph()
-                            p.style = "A二级标题"
-                            p.add_run(match.group(1))
-                    # 三级标题处理
-                    elif line.startswith('<div class="threetitle"'):
-                        match = re.search(r'>(.*?)</div>', line)
-                        if match:
+                target_doc = Document(io.BytesIO(merged_bytes))
+
+                # 预先确定模板中实际可用的样式，缺失时依次回退到内置样式和默认样式
+                available_styles = frozenset(s.name for s in target_doc.styles)
+                resolved_styles = {
+                    name: name if name in available_styles else (fallback if fallback in available_styles else None)
+                    for name, fallback in FALLBACK_STYLES.items()
+                }
+                # 表格总宽度取最后一节页面的版心宽度，与python-docx的add_table一致
+                section = target_doc.sections[-1]
+                block_width = (
+                    (section.page_width or Inches(8.5))
+                    - (section.left_margin or Inches(1))
+                    - (section.right_margin or Inches(1))
+                )
+                root = html.fragment_fromstring(escape_stray_lt(markdown_content), create_parent="div")
+
+                # <br>按换行处理，使其前后的文字分属不同段落
+                for br in root.iter('br'):
+                    br.tail = '\n' + (br.tail or '')
+
+                def add_text_paragraphs(text, style="A正文"):
+                    # 非空文本按行写入段落，默认为正文样式
+                    for line in (text or '').split('\n'):
+                        line = line.strip()
+                        if line:
                             p = target_doc.add_paragraph()
-                            p.style = "A三级标题"
-                            p.add_run(match.group(1))
-                    # 表格处理 - 修复版本
-                    elif line.startswith('<table>'):
-                        table_data = []
-                        i += 1  # 跳过 <table> 行
-                        table_content = []
-
-                        # 收集表格内容，直到遇到 </table>
-                        while i < len(lines) and not lines[i].strip().startswith('</table>'):
-                            table_content.append(lines[i])
-                            i += 1
-
-                        # 现在 i 指向 </table> 行，我们需要处理这个表格
-                        table_text = '\n'.join(table_content)
-                        print(f"表格内容长度: {len(table_text)}")
-
-                        # 提取表头
-                        header_match = re.search(r'<thead>(.*?)</thead>', table_text, re.DOTALL)
-                        if header_match:
-                            header_content = header_match.group(1)
-                            header_row = re.findall(r'<th>(.*?)</th>', header_content, re.DOTALL)
-                            if header_row:
-                                table_data.append([cell.strip() for cell in header_row])
-                                print(f"提取到表头: {header_row}")
-
-                        # 提取表体
-                        body_match = re.search(r'<tbody>(.*?)</tbody>', table_text, re.DOTALL)
-                        if body_match:
-                            body_content = body_match.group(1)
-                            rows = re.findall(r'<tr>(.*?)</tr>', body_content, re.DOTALL)
-                            for row in rows:
-                                # 同时匹配 th 和 td，因为您的表格中表体也使用了 th
-                                cells = re.findall(r'<(?:th|td)>(.*?)</(?:th|td)>', row, re.DOTALL)
-                                if cells:
-                                    table_data.append([cell.strip() for cell in cells])
-                                    print(f"提取到行数据: {cells}")
-
-                        # 创建表格
-                        if table_data and len(table_data) > 0:
-                            print(f"创建表格，行数: {len(table_data)}，列数: {len(table_data[0])}")
-                            table = target_doc.add_table(rows=1, cols=len(table_data[0]))
-                            table.style = 'Table Grid'
-
-                            # 设置表格字体
-                            for row in table.rows:
-                                for cell in row.cells:
-                                    for paragraph in cell.paragraphs:
-                                        for run in paragraph.runs:
-                                            run.font.size = Pt(10)
-
-                            # 设置表头
-                            hdr_cells = table.rows[0].cells
-                            for j, cell in enumerate(table_data[0]):
-                                hdr_cells[j].text = cell
-                                for paragraph in hdr_cells[j].paragraphs:
-                                    paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                                    for run in paragraph.runs:
-                                        run.bold = True
-                                        run.font.size = Pt(10)
-                                # 表头背景色
-                                shading_elm = parse_xml(r'<w:shd {} w:fill="5B9BD5"/>'.format(nsdecls('w')))
-                                hdr_cells[j]._tc.get_or_add_tcPr().append(shading_elm)
-
-                            # 添加数据行
-                            for row in table_data[1:]:
-                                row_cells = table.add_row().cells
-                                for j, cell in enumerate(row):
-                                    row_cells[j].text = cell
-                                    for paragraph in row_cells[j].paragraphs:
-                                        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                                        for run in paragraph.runs:
-                                            run.font.size = Pt(10)
-                    # 其他非空行处理
-                    elif line != '' and not line.startswith('</'):
-                        p = target_doc.add_paragraph()
-                        p.style = "A正文"
-                        p.add_run(line)
-
-                    i += 1
+                            # 没有回退配置的样式（如新增的class）在模板缺失时使用默认样式
+                            p.style = resolved_styles.get(style, style if style in available_styles else None)
+                            p.add_run(line)
+
+                def add_table(el):
+                    table_data = []
+
+                    # 提取表头
+                    header_row = [th.text_content().strip() for th in el.xpath('./thead/tr/th')]
+                    if header_row:
+                        table_data.append(header_row)
+                        logger.debug("提取到表头: %s", header_row)
+
+                    # 提取表体，同时匹配 th 和 td，因为表体中也可能使用 th
+                    for tr in el.xpath('./tbody/tr'):
+                        cells = [c.text_content().strip() for c in tr.xpath('./th|./td')]
+                        if cells:
+                            table_data.append(cells)
+                            logger.debug("提取到行数据: %s", cells)
+
+                    # 创建表格
+                    if table_data and len(table_data) > 0:
+                        logger.debug("创建表格，行数: %d，列数: %d", len(table_data), len(table_data[0]))
+                        # 一次性生成整张表格的XML并插入到正文末尾（节属性sectPr之前）
+                        col_width = Emu(block_width // len(table_data[0])).twips
+                        style_id = None
+                        if TABLE_STYLE in available_styles:
+                            style_id = target_doc.styles[TABLE_STYLE].style_id
+                        tbl = parse_xml(build_table_xml(table_data, col_width, style_id))
+                        body = target_doc.element.body
+                        if body.sectPr is not None:
+                            body.sectPr.addprevious(tbl)
+                        else:
+                            body.append(tbl)
+
+                def add_blocks(text, elements):
+                    # 行内元素的文字并入当前文本，遇到块级元素时先把已积累的文本按行写入正文
+                    pending = [text or '']
+                    for el in elements:
+                        # 注释等非元素节点
+                        if not isinstance(el.tag, str):
+                            pass
+                        # 行内元素
+                        elif not is_block_element(el):
+                            pending.append(el.text_content())
+                        else:
+                            add_text_paragraphs(''.join(pending))
+                            pending = []
+                            # 标题及正文处理：div自身的行内文字作为段落，内嵌的div、表格等单独处理
+                            if el.tag == 'div' and el.get("class") in STYLE_BY_CLASS:
+                                children = list(el.iterchildren())
+                                inline = [el.text or '']
+                                k = 0
+                                while k < len(children) and not is_block_element(children[k]):
+                                    if isinstance(children[k].tag, str):
+                                        inline.append(children[k].text_content())
+                                    inline.append(children[k].tail or '')
+                                    k += 1
+                                add_text_paragraphs(''.join(inline), STYLE_BY_CLASS[el.get("class")])
+                                add_blocks('', children[k:])
+                            # 表格处理
+                            elif el.tag == 'table':
+                                add_table(el)
+                            # 其他块级元素（无样式的div包裹层等）递归处理其内容
+                            else:
+                                add_blocks(el.text, el.iterchildren())
+                        pending.append(el.tail or '')
+                    add_text_paragraphs(''.join(pending))
+
+                add_blocks(root.text, root.iterchildren())
 
                 # 将docx保存到字节流
                 doc_bytes = io.BytesIO()
@@ -445,16 +547,7 @@ class DocxWithTemplateStyleTool(Tool):
                 return doc_bytes.getvalue()
 
             except Exception as e:
-                print(f"处理文档时发生未知错误: {str(e)}")
-                import traceback
-                traceback.print_exc()
-
-            finally:
-                # 清理临时文件
-                if os.path.exists(tmp_template):
-                    os.remove(tmp_template)
-                if os.path.exists(tmp_output):
-                    os.remove(tmp_output)
+                logger.exception("处理文档时发生未知错误: %s", e)
 
 
 
@@ -479,18 +572,17 @@ class DocxWithTemplateStyleTool(Tool):
             else:
                 raise TypeError("模板文件格式错误，需要Dify文件对象或字节流")
 
-            # 验证字节流有效性（尝试解压验证是否为docx）
+            # 验证字节流有效性：先检查ZIP文件头，docx必需的核心文件在合并模板样式时检查
+            if not template_bytes.startswith(b'PK\x03\x04'):
+                raise ValueError("模板文件不是有效的ZIP压缩文件（可能不是DOCX）")
             try:
-                with zipfile.ZipFile(io.BytesIO(template_bytes)) as test_zip:
-                    # 检查docx必需的核心文件
-                    required_files = ['[Content_Types].xml', 'word/document.xml']
-                    if not all(f in test_zip.namelist() for f in required_files):
-                        raise ValueError("模板文件不是有效的DOCX格式")
+                # 复制模板样式到空白docx
+                merged_bytes = merged_template_for(template_bytes)
             except zipfile.BadZipFile:
                 raise ValueError("模板文件不是有效的ZIP压缩文件（可能不是DOCX）")
 
             # 生成最终docx
-            final_docx_bytes = generate_docx_with_template(template_bytes, markdown_content)
+            final_docx_bytes = generate_docx_with_template(merged_bytes, markdown_content)
             # final_docx_bytes = template_file.blob
 
             # 输出结果